@@ -10,64 +10,190 @@ A macro/hotkey program for Adafruit MACROPAD with an integrated Dragon Drop game
 import os
 import time
 import displayio
+import supervisor
 import terminalio
 from adafruit_display_shapes.rect import Rect
 from adafruit_display_text import label
 from adafruit_macropad import MacroPad
+from micropython import const
 import dragondrop_game  # Import the Dragon Drop game module
 
 # CONFIGURABLES ------------------------
 MACRO_FOLDER = '/macros'
-GAME_KEY = 11  # Key to press to start the Dragon Drop game (Key 11 is the last key)
+GAME_KEY = const(11)  # Key to press to start the Dragon Drop game (Key 11 is the last key)
+ENCODER_SETTLE_MS = const(15)  # Encoder must hold a new position this long to switch apps
+DEBUG = const(0)  # Set to 1 for serial console messages from the main loop
+TICKS_MASK = const(0x1FFFFFFF)  # supervisor.ticks_ms() wraps around at 2**29
+
+# Exceptions a broken macro file may raise; that file is skipped
+MACRO_ERRORS = (SyntaxError, ImportError, AttributeError, KeyError, NameError,
+                IndexError, TypeError)
 
 # CLASSES AND FUNCTIONS ----------------
+def bind(func, *args):
+    """Return a zero-argument callable that invokes func(*args). Stands in
+    for functools.partial, which CircuitPython does not provide."""
+    return lambda: func(*args)
+
+def sleep_ticks(ms):
+    """Wait the given number of milliseconds, measured against a fixed start
+    on supervisor.ticks_ms() so time spent between polls counts toward the
+    delay. Sleeps 1 ms at a time rather than spinning, then polls for the
+    last couple of milliseconds."""
+    start = supervisor.ticks_ms()
+    while True:
+        remaining = ms - ((supervisor.ticks_ms() - start) & TICKS_MASK)
+        if remaining <= 0:
+            return
+        if remaining > 2:
+            time.sleep(0.001)
+
+def compile_sequence(sequence):
+    """Convert a macro key sequence into two lists of zero-argument callables,
+    run in order when the key is pressed and released respectively. Doing the
+    type dispatch once here keeps it out of the main loop."""
+    press = []
+    release = []
+    for item in sequence:
+        if isinstance(item, int):
+            if item >= 0:
+                press.append(bind(kbd_press, item))
+                release.append(bind(kbd_release, item))
+            else:
+                press.append(bind(kbd_release, -item))
+        elif isinstance(item, float):
+            press.append(bind(sleep_ticks, round(item * 1000)))
+        elif isinstance(item, str):
+            press.append(bind(kl_write, item))
+        elif isinstance(item, list):
+            # Pressing a Consumer Control code replaces the previous one, so
+            # release only before the first code and between repeats
+            last_code = None
+            for code in item:
+                if isinstance(code, int):
+                    if last_code is None or code == last_code:
+                        press.append(cc_release)
+                    press.append(bind(cc_press, code))
+                    last_code = code
+                elif isinstance(code, float):
+                    press.append(bind(sleep_ticks, round(code * 1000)))
+        elif isinstance(item, dict):
+            buttons = item.get('buttons')
+            if buttons is not None:
+                if buttons >= 0:
+                    press.append(bind(mouse_press, buttons))
+                    release.append(bind(mouse_release, buttons))
+                else:
+                    press.append(bind(mouse_release, -buttons))
+            x, y, wheel = item.get('x', 0), item.get('y', 0), item.get('wheel', 0)
+            if x or y or wheel:  # Skip the no-op move for button/tone-only items
+                press.append(bind(mouse_move, x, y, wheel))
+            if 'tone' in item:
+                press.append(macropad.stop_tone)
+                if item['tone'] > 0:
+                    press.append(bind(macropad.start_tone, item['tone']))
+            elif 'play' in item:
+                press.append(bind(macropad.play_file, item['play']))
+    release.append(cc_release)
+    return press, release
+
 class App:
     """Class representing a host-side application, for which we have a set of macro sequences."""
     def __init__(self, appdata):
         self.name = appdata['name']
         self.macros = appdata['macros']
+        self.n_macros = len(self.macros)
+        # LED colors and labels for all 12 keys, unused keys padded out
+        padding = max(0, 12 - len(self.macros))
+        self.colors = [m[0] for m in self.macros[:12]] + [0] * padding
+        self.labels = [m[1] for m in self.macros[:12]] + [''] * padding
+        # Compiled by switch() only while this app is active, to save RAM
+        self.press_actions = None
+        self.release_actions = None
 
     def switch(self):
         """Activate application settings; update OLED labels and LED colors."""
-        group[13].text = self.name  # Application name
+        global hid_dirty, active_app  # pylint: disable=global-statement
+        if active_app is not self:
+            if active_app is not None:  # Free the outgoing app's actions
+                active_app.press_actions = None
+                active_app.release_actions = None
+            self.press_actions = []
+            self.release_actions = []
+            for macro in self.macros:
+                press, release = compile_sequence(macro[2])
+                self.press_actions.append(press)
+                self.release_actions.append(release)
+            active_app = self
+        # Only touch labels and pixels whose contents actually change;
+        # neighboring apps often share much of their layout.
+        if title_label.text != self.name:
+            title_label.text = self.name  # Application name
         if self.name:
             rect.fill = 0xFFFFFF
         else:  # empty app name indicates blank screen
             rect.fill = 0x000000
+        pixels_changed = False
+        colors = self.colors
+        labels = self.labels
         for i in range(12):
-            if i < len(self.macros):  # Key in use, set label + LED color
-                macropad.pixels[i] = self.macros[i][0]
-                group[i].text = self.macros[i][1]
-            else:  # Key not in use, no label or LED
-                macropad.pixels[i] = 0
-                group[i].text = ''
-        macropad.keyboard.release_all()
-        macropad.consumer_control.release()
-        macropad.mouse.release_all()
-        macropad.stop_tone()
-        macropad.pixels.show()
+            color = colors[i]
+            if pixel_colors[i] != color:
+                macropad.pixels[i] = color
+                pixel_colors[i] = color
+                pixels_changed = True
+        for i in range(12):
+            text = labels[i]
+            if key_labels[i].text != text:
+                key_labels[i].text = text
+        if hid_dirty:  # Only send release reports if a macro has run
+            macropad.keyboard.release_all()
+            macropad.consumer_control.release()
+            macropad.mouse.release_all()
+            macropad.stop_tone()
+            hid_dirty = False
+        if pixels_changed:
+            macropad.pixels.show()
         macropad.display.refresh()
 
 # INITIALIZATION -----------------------
 macropad = MacroPad()
 macropad.display.auto_refresh = False
 macropad.pixels.auto_write = False
+pixel_colors = [None] * 12  # Last color written to each key's LED
+hid_dirty = True  # Set once a macro has pressed something; cleared on switch
+active_app = None  # App whose macro actions are currently compiled
+
+# Bound methods used by compiled macro sequences, looked up once here
+kbd_press = macropad.keyboard.press
+kbd_release = macropad.keyboard.release
+kl_write = macropad.keyboard_layout.write
+cc_press = macropad.consumer_control.press
+cc_release = macropad.consumer_control.release
+mouse_press = macropad.mouse.press
+mouse_release = macropad.mouse.release
+mouse_move = macropad.mouse.move
 
 # Set up displayio group with all the labels
+font = terminalio.FONT
+display_width = macropad.display.width
+display_height = macropad.display.height
+positions = [((display_width - 1) * (i % 3) / 2,
+              display_height - 1 - (3 - i // 3) * 12) for i in range(12)]
+# Key labels, header bar and title; App.switch() updates these directly
+key_labels = [label.Label(font, text='', color=0xFFFFFF,
+                          anchored_position=positions[key_index],
+                          anchor_point=((key_index % 3) / 2, 1.0))
+              for key_index in range(12)]
+rect = Rect(0, 0, display_width, 13, fill=0xFFFFFF)
+title_label = label.Label(font, text='', color=0x000000,
+                          anchored_position=(display_width//2, 0),
+                          anchor_point=(0.5, 0.0))
 group = displayio.Group()
-for key_index in range(12):
-    x = key_index % 3
-    y = key_index // 3
-    group.append(label.Label(terminalio.FONT, text='', color=0xFFFFFF,
-                             anchored_position=((macropad.display.width - 1) * x / 2,
-                                                macropad.display.height - 1 -
-                                                (3 - y) * 12),
-                             anchor_point=(x / 2, 1.0)))
-rect = Rect(0, 0, macropad.display.width, 13, fill=0xFFFFFF)
+for key_label in key_labels:
+    group.append(key_label)
 group.append(rect)
-group.append(label.Label(terminalio.FONT, text='', color=0x000000,
-                         anchored_position=(macropad.display.width//2, 0),
-                         anchor_point=(0.5, 0.0)))
+group.append(title_label)
 
 # Macro menu group for the macro menu
 macro_menu_group = group  # Assign the macro menu to a variable
@@ -76,101 +202,91 @@ macropad.display.root_group = group
 
 # Load all the macro key setups from .py files in MACRO_FOLDER
 apps = []
-files = os.listdir(MACRO_FOLDER)
-files.sort()
+prefix = MACRO_FOLDER + '/'
+files = sorted(f for f in os.listdir(MACRO_FOLDER)
+               if f[-3:] == '.py' and f[:2] != '._')  # Skip macOS ._ files
 for filename in files:
-    if filename.endswith('.py') and not filename.startswith('._'):
-        try:
-            module = __import__(MACRO_FOLDER + '/' + filename[:-3])
-            apps.append(App(module.app))
-        except (SyntaxError, ImportError, AttributeError, KeyError, NameError,
-                IndexError, TypeError) as err:
-            print(f"ERROR in {filename}: {err}")
+    try:
+        module = __import__(prefix + filename[:-3])
+        apps.append(App(module.app))
+    except MACRO_ERRORS as err:
+        print(f"ERROR in {filename}: {err}")
 
 if not apps:
-    group[13].text = 'NO MACRO FILES FOUND'
+    title_label.text = 'NO MACRO FILES FOUND'
     macropad.display.refresh()
-    while True:
-        pass
+    while True:  # Nothing to service; sleep rather than spin the CPU
+        time.sleep(1.0)
 
 # Add game mode as an App
 last_position = None
+pending_position = None
+pending_since = 0
 app_index = 0
 apps.append(App({'name': 'Dragon Drop', 'macros': []}))  # Add "Dragon Drop" as an app
+len_apps = len(apps)
+game_app_index = len_apps - 1
+in_game_app = app_index == game_app_index
 apps[app_index].switch()
+current_n = apps[app_index].n_macros
+press_actions = apps[app_index].press_actions
+release_actions = apps[app_index].release_actions
+keys_events_get = macropad.keys.events.get
 
 # MAIN LOOP ----------------------------
 while True:
-    # Read encoder position. If it's changed, switch apps.
+    # Read encoder position. If it's changed and held steady, switch apps.
     position = macropad.encoder
     if position != last_position:
-        app_index = position % len(apps)  # Handle wrap-around between apps
-        apps[app_index].switch()  # Switch to the selected app
-        last_position = position
+        now = supervisor.ticks_ms()
+        if position != pending_position:  # Still moving, restart the wait
+            pending_position = position
+            pending_since = now
+        elif (now - pending_since) & TICKS_MASK >= ENCODER_SETTLE_MS:
+            app_index = position % len_apps  # Handle wrap-around between apps
+            in_game_app = app_index == game_app_index
+            apps[app_index].switch()  # Switch to the selected app
+            current_n = apps[app_index].n_macros
+            press_actions = apps[app_index].press_actions
+            release_actions = apps[app_index].release_actions
+            last_position = position
+    else:  # Bounced back, so any new position starts a fresh wait
+        pending_position = last_position
 
     # Handle key events
-    event = macropad.keys.events.get()
-    if event:
-        if app_index == len(apps) - 1:  # "Dragon Drop" app is selected
-            if event.pressed and event.key_number == GAME_KEY:
+    event = keys_events_get()
+    if event is None:
+        # Idle: yield briefly instead of spinning flat out
+        if position == last_position:
+            time.sleep(0.001)
+        continue
+    key_number = event.key_number
+    pressed = event.pressed
+
+    if in_game_app:  # "Dragon Drop" app is selected
+        if pressed and key_number == GAME_KEY:
+            if DEBUG:
                 print("Starting Dragon Drop game...")
-                result = dragondrop_game.run_game(macropad)  # Pass the macropad instance
-                if result == "game_ended":
+            result = dragondrop_game.run_game(macropad)  # Pass the macropad instance
+            if result == "game_ended":
+                if DEBUG:
                     print("Exiting Dragon Drop game...")
-                    # Reset to macro menu display group
-                    macropad.display.rotation = 0  # Reset display rotation to default
-                    macropad.display.root_group = macro_menu_group
-                    macropad.display.refresh()
-            elif event.pressed:
-                # Any other keypress while in game selection skips the game
-                print(f"Key {event.key_number} pressed. Skipping game.")
+                # Reset to macro menu display group
+                macropad.display.rotation = 0  # Reset display rotation to default
+                macropad.display.root_group = macro_menu_group
+                macropad.display.refresh()
+        elif pressed:
+            # Any other keypress while in game selection skips the game
+            if DEBUG:
+                print(f"Key {key_number} pressed. Skipping game.")
+    else:
+        # Handle key events for macro apps
+        if key_number >= current_n:
+            continue
+        if pressed:
+            hid_dirty = True
+            for action in press_actions[key_number]:
+                action()
         else:
-            # Handle key events for macro apps
-            if event.key_number >= len(apps[app_index].macros):
-                continue
-            key_number = event.key_number
-            pressed = event.pressed
-
-            sequence = apps[app_index].macros[key_number][2]
-            if pressed:
-                for item in sequence:
-                    if isinstance(item, int):
-                        if item >= 0:
-                            macropad.keyboard.press(item)
-                        else:
-                            macropad.keyboard.release(-item)
-                    elif isinstance(item, float):
-                        time.sleep(item)
-                    elif isinstance(item, str):
-                        macropad.keyboard_layout.write(item)
-                    elif isinstance(item, list):
-                        for code in item:
-                            if isinstance(code, int):
-                                macropad.consumer_control.release()
-                                macropad.consumer_control.press(code)
-                            if isinstance(code, float):
-                                time.sleep(code)
-                    elif isinstance(item, dict):
-                        if 'buttons' in item:
-                            if item['buttons'] >= 0:
-                                macropad.mouse.press(item['buttons'])
-                            else:
-                                macropad.mouse.release(-item['buttons'])
-                        macropad.mouse.move(item.get('x', 0), item.get('y', 0), item.get('wheel', 0))
-                        if 'tone' in item:
-                            if item['tone'] > 0:
-                                macropad.stop_tone()
-                                macropad.start_tone(item['tone'])
-                            else:
-                                macropad.stop_tone()
-                        elif 'play' in item:
-                            macropad.play_file(item['play'])
-            else:
-                for item in sequence:
-                    if isinstance(item, int):
-                        if item >= 0:
-                            macropad.keyboard.release(item)
-                    elif isinstance(item, dict) and 'buttons' in item:
-                        if item['buttons'] >= 0:
-                            macropad.mouse.release(item['buttons'])
-                macropad.consumer_control.release()
+            for action in release_actions[key_number]:
+                action()